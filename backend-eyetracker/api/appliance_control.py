@@ -4,12 +4,17 @@ Control ESP8266 appliances via MQTT
 """
 
 import os
-import json
+import hmac
+import asyncio
 import logging
-from typing import Dict, List, Optional
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field
-import paho.mqtt.client as mqtt
+from contextlib import asynccontextmanager, suppress
+from types import MappingProxyType
+from typing import Dict, List, Literal, Mapping, Optional
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+import orjson
+import aiomqtt
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,96 +31,307 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_CONTROL_TOPIC = os.getenv("MQTT_CONTROL_TOPIC", "biosync/appliances/control")
 MQTT_STATE_TOPIC = os.getenv("MQTT_STATE_TOPIC", "biosync/appliances/state")
 APPLIANCE_PASSWORD = os.getenv("APPLIANCE_PASSWORD", "appliances123")
+MQTT_RECONNECT_SECONDS = float(os.getenv("MQTT_RECONNECT_SECONDS", "5"))
+MQTT_PUBLISH_TIMEOUT = float(os.getenv("MQTT_PUBLISH_TIMEOUT", "2"))
+MQTT_DEFAULT_QOS = int(os.getenv("MQTT_DEFAULT_QOS", "1"))
+MQTT_BATCH_MS = float(os.getenv("MQTT_BATCH_MS", "10"))
 
-# Global MQTT client
-mqtt_client: Optional[mqtt.Client] = None
-latest_state: Dict[str, str] = {}
+if MQTT_DEFAULT_QOS not in (0, 1, 2):
+    raise ValueError(f"MQTT_DEFAULT_QOS must be 0, 1 or 2, got {MQTT_DEFAULT_QOS}")
+
+# Controllable ESP8266 pins
+_VALID_PINS = frozenset(f"d{i}" for i in range(9))
+
+# Serialized /all/{state} MQTT messages (only sent once the password matches)
+_ALL_PIN_BYTES = {
+    s: orjson.dumps({
+        "password": APPLIANCE_PASSWORD,
+        "pins": {f"d{i}": s for i in range(9)}
+    })
+    for s in ("on", "off", "high", "low")
+}
+
+# MQTT connection status (the client itself lives on app.state.mqtt)
+mqtt_connected = False
+# Read-only snapshot, replaced wholesale on every state update
+latest_state: Mapping[str, str] = MappingProxyType({})
 
 
 # ===== SCHEMAS =====
+PinState = Literal["on", "off", "high", "low"]
+
+
 class PinControl(BaseModel):
     """Individual pin control"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     name: str = Field(..., description="Pin name (d0-d8)", pattern="^d[0-8]$")
-    state: str = Field(..., description="Pin state (on/off or high/low)")
+    state: PinState = Field(..., description="Pin state (on/off or high/low)")
 
 
 class ApplianceControlRequest(BaseModel):
     """Request to control appliances"""
-    pins: Dict[str, str] = Field(
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    pins: Dict[str, PinState] = Field(
         ...,
-        description="Pin states to set. Key: pin name (d0-d8), Value: state (on/off)",
+        description="Pin states to set. Key: pin name (d0-d8), Value: state (on/off/high/low)",
         example={"d0": "on", "d1": "off", "d2": "on"}
     )
     password: str = Field(..., description="Control password for security")
 
+    @field_validator("pins")
+    @classmethod
+    def validate_pin_names(cls, v):
+        """Normalize pin names to lowercase and reject unknown pins"""
+        pins = {}
+        for name, state in v.items():
+            pin_name = name.lower()
+            if pin_name not in _VALID_PINS:
+                raise ValueError(f"Invalid pin name: {name}. Must be d0-d8")
+            pins[pin_name] = state
+        return pins
+
 
 class ApplianceStateResponse(BaseModel):
     """Current state of all appliances"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     pins: Dict[str, str] = Field(..., description="Current pin states")
     connected: bool = Field(..., description="Whether ESP is connected")
 
 
 class ApplianceControlResponse(BaseModel):
     """Response after controlling appliances"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     success: bool
     message: str
     pins_updated: List[str]
 
 
-# ===== MQTT CALLBACKS =====
-def on_connect(client, userdata, flags, rc):
-    """Called when connected to MQTT broker"""
-    if rc == 0:
-        logger.info(f"✅ Connected to MQTT broker: {MQTT_BROKER}")
-        client.subscribe(MQTT_STATE_TOPIC)
-        logger.info(f"📡 Subscribed to state topic: {MQTT_STATE_TOPIC}")
-    else:
-        logger.error(f"❌ MQTT connection failed with code: {rc}")
-
-
-def on_message(client, userdata, msg):
+# ===== MQTT HANDLERS =====
+def on_message(message: aiomqtt.Message):
     """Called when receiving MQTT message"""
     global latest_state
     try:
-        payload = json.loads(msg.payload.decode())
-        latest_state = payload
+        payload = orjson.loads(message.payload)
+        latest_state = MappingProxyType(dict(payload))
         logger.info(f"📥 Received state update: {payload}")
     except Exception as e:
         logger.error(f"❌ Error parsing state message: {e}")
 
 
-def on_disconnect(client, userdata, rc):
-    """Called when disconnected from MQTT broker"""
-    logger.warning(f"⚠️ Disconnected from MQTT broker. Code: {rc}")
+async def run_mqtt(client: aiomqtt.Client):
+    """Keep the MQTT connection alive and consume state updates"""
+    global mqtt_connected
+    
+    while True:
+        try:
+            logger.info(f"🔄 Connecting to MQTT broker: {MQTT_BROKER}:{MQTT_PORT}")
+            async with client:
+                mqtt_connected = True
+                logger.info(f"✅ Connected to MQTT broker: {MQTT_BROKER}")
+                
+                await client.subscribe(MQTT_STATE_TOPIC)
+                logger.info(f"📡 Subscribed to state topic: {MQTT_STATE_TOPIC}")
+                
+                async for message in client.messages:
+                    on_message(message)
+        except aiomqtt.MqttError as e:
+            logger.warning(f"⚠️ Disconnected from MQTT broker: {e}")
+        finally:
+            mqtt_connected = False
+        
+        await asyncio.sleep(MQTT_RECONNECT_SECONDS)
 
 
-# ===== MQTT INITIALIZATION =====
-def init_mqtt():
-    """Initialize MQTT client"""
-    global mqtt_client
-    
-    if mqtt_client is not None:
-        return mqtt_client
+# ===== MQTT LIFECYCLE =====
+@asynccontextmanager
+async def mqtt_lifespan(app: FastAPI):
+    """Run the MQTT client for the lifetime of the app"""
+    client = aiomqtt.Client(
+        MQTT_BROKER,
+        MQTT_PORT,
+        identifier="biosync_backend",
+        keepalive=60
+    )
+    batcher = _ToggleBatcher(client)
+    app.state.mqtt = client
+    app.state.toggle_batcher = batcher
+    tasks = [
+        asyncio.create_task(run_mqtt(client)),
+        asyncio.create_task(batcher.run())
+    ]
     
     try:
-        mqtt_client = mqtt.Client(client_id="biosync_backend")
-        mqtt_client.on_connect = on_connect
-        mqtt_client.on_message = on_message
-        mqtt_client.on_disconnect = on_disconnect
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        batcher.close()
+        logger.info("👋 MQTT client disconnected")
+
+
+# ===== CONTROL HELPERS =====
+# Shared /all/{state} response (frozen model, safe to reuse)
+_ALL_PINS_RESPONSE = ApplianceControlResponse(
+    success=True,
+    message="Control commands sent successfully",
+    pins_updated=sorted(_VALID_PINS)
+)
+
+
+def _error(status_code: int, detail: str) -> ORJSONResponse:
+    """Error response in the same shape FastAPI uses for HTTPException"""
+    return ORJSONResponse(status_code=status_code, content={"detail": detail})
+
+
+def _check_control(password: str) -> Optional[ORJSONResponse]:
+    """Return an error response unless MQTT is connected and the password matches"""
+    if not mqtt_connected:
+        return _error(503, "MQTT client not available")
+    
+    # Validate password
+    # (compare bytes: compare_digest rejects non-ASCII str)
+    if not hmac.compare_digest(password.encode(), APPLIANCE_PASSWORD.encode()):
+        return _error(401, "Invalid password")
+    
+    return None
+
+
+async def _publish(client: aiomqtt.Client, payload: bytes, qos: int):
+    """Publish a serialized control message to the ESP8266 (raises aiomqtt.MqttError)"""
+    await client.publish(
+        MQTT_CONTROL_TOPIC,
+        payload=payload,
+        qos=qos,
+        retain=False,
+        timeout=MQTT_PUBLISH_TIMEOUT
+    )
+
+
+async def _publish_pins(
+    client: aiomqtt.Client,
+    pins: Mapping[str, str],
+    password: str,
+    qos: int = MQTT_DEFAULT_QOS
+) -> ApplianceControlResponse:
+    """Publish already-validated pin states once the password has been checked"""
+    # Prepare MQTT message
+    mqtt_payload = {
+        "password": password,
+        "pins": dict(pins)
+    }
+    
+    # Publish to MQTT
+    await _publish(client, orjson.dumps(mqtt_payload), qos)
+    
+    logger.info(f"✅ Published control command: {mqtt_payload}")
+    
+    return ApplianceControlResponse(
+        success=True,
+        message="Control commands sent successfully",
+        pins_updated=list(pins.keys())
+    )
+
+
+class _ToggleBatcher:
+    """Coalesce toggles arriving within MQTT_BATCH_MS into one control message"""
+
+    def __init__(self, client: aiomqtt.Client):
+        self.client = client
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.added = asyncio.Event()
+        self.inflight: List[asyncio.Future] = []
+        self.closed = False
+
+    async def submit(self, pin_name: str, state: str):
+        """Queue a pin state and wait until its batch is published"""
+        if self.closed:
+            raise aiomqtt.MqttError("MQTT client shutting down")
         
-        logger.info(f"🔄 Connecting to MQTT broker: {MQTT_BROKER}:{MQTT_PORT}")
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        mqtt_client.loop_start()
+        waiter = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((pin_name, state, waiter))
+        self.added.set()
+        await waiter
+
+    async def _next(self, deadline: float):
+        """Return the next queued toggle, or None once the window closes"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                # Waiting on an Event (not queue.get) so a timeout never drops an item
+                self.added.clear()
+                try:
+                    await asyncio.wait_for(self.added.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+
+    async def run(self):
+        """Publish queued toggles, one merged message per batch window"""
+        loop = asyncio.get_running_loop()
         
-        return mqtt_client
-    except Exception as e:
-        logger.error(f"❌ Failed to initialize MQTT: {e}")
-        raise
+        while True:
+            pin_name, state, waiter = await self.queue.get()
+            pins = {pin_name: state}
+            waiters = self.inflight = [waiter]
+            
+            # Latest state wins; stop early once every pin is covered
+            deadline = loop.time() + MQTT_BATCH_MS / 1000
+            while len(pins) < len(_VALID_PINS):
+                item = await self._next(deadline)
+                if item is None:
+                    break
+                pin_name, state, waiter = item
+                pins[pin_name] = state
+                waiters.append(waiter)
+            
+            mqtt_payload = {
+                "password": APPLIANCE_PASSWORD,
+                "pins": pins
+            }
+            try:
+                await _publish(self.client, orjson.dumps(mqtt_payload), qos=1)
+            except Exception as e:
+                _resolve(waiters, e)
+            else:
+                logger.info(f"✅ Published control command: {mqtt_payload}")
+                _resolve(waiters)
+            self.inflight = []
+
+    def close(self):
+        """Fail queued and in-flight toggles once run() has been cancelled"""
+        self.closed = True
+        waiters = self.inflight
+        self.inflight = []
+        while not self.queue.empty():
+            waiters.append(self.queue.get_nowait()[2])
+        _resolve(waiters, aiomqtt.MqttError("MQTT client shutting down"))
+
+
+def _resolve(waiters: List[asyncio.Future], error: Optional[BaseException] = None):
+    """Complete toggle waiters that are still pending"""
+    for waiter in waiters:
+        if waiter.done():
+            continue
+        if error is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(error)
 
 
 # ===== API ENDPOINTS =====
 @router.post("/control", response_model=ApplianceControlResponse)
-async def control_appliances(request: ApplianceControlRequest):
+async def control_appliances(control: ApplianceControlRequest, request: Request):
     """
     Control appliance pins via MQTT
     
@@ -134,58 +350,17 @@ async def control_appliances(request: ApplianceControlRequest):
     }
     ```
     """
+    error = _check_control(control.password)
+    if error is not None:
+        return error
+    
     try:
-        # Initialize MQTT if not already
-        client = init_mqtt()
-        if client is None:
-            raise HTTPException(status_code=503, detail="MQTT client not available")
-        
-        # Validate password
-        if request.password != APPLIANCE_PASSWORD:
-            raise HTTPException(status_code=401, detail="Invalid password")
-        
-        # Validate pin names
-        valid_pins = [f"d{i}" for i in range(9)]
-        for pin_name in request.pins.keys():
-            if pin_name.lower() not in valid_pins:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid pin name: {pin_name}. Must be d0-d8"
-                )
-        
-        # Prepare MQTT message
-        mqtt_payload = {
-            "password": request.password,
-            "pins": request.pins
-        }
-        
-        # Publish to MQTT
-        result = client.publish(
-            MQTT_CONTROL_TOPIC,
-            json.dumps(mqtt_payload),
-            qos=1,
-            retain=False
-        )
-        
-        if result.rc != mqtt.MQTT_ERR_SUCCESS:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to publish MQTT message"
-            )
-        
-        logger.info(f"✅ Published control command: {mqtt_payload}")
-        
-        return ApplianceControlResponse(
-            success=True,
-            message="Control commands sent successfully",
-            pins_updated=list(request.pins.keys())
+        return await _publish_pins(
+            request.app.state.mqtt, control.pins, control.password
         )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
+    except aiomqtt.MqttError as e:
         logger.error(f"❌ Error controlling appliances: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        return _error(500, "Failed to publish MQTT message")
 
 
 @router.get("/state", response_model=ApplianceStateResponse)
@@ -195,91 +370,72 @@ async def get_appliance_state():
     
     Returns the last known state received from the ESP8266 via MQTT.
     """
-    try:
-        # Initialize MQTT if not already
-        client = init_mqtt()
-        
-        return ApplianceStateResponse(
-            pins=latest_state,
-            connected=client is not None and client.is_connected()
-        )
-        
-    except Exception as e:
-        logger.error(f"❌ Error getting appliance state: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    snapshot = latest_state
+    
+    return ApplianceStateResponse(
+        pins=snapshot,
+        connected=mqtt_connected
+    )
 
 
 @router.post("/toggle/{pin_name}")
-async def toggle_pin(pin_name: str, password: str):
+async def toggle_pin(pin_name: str, password: str, request: Request):
     """
     Toggle a single pin on/off
     
     Convenience endpoint to flip a pin's state without knowing current state.
     """
+    # Validate pin name
+    pin_name = pin_name.lower()
+    if pin_name not in _VALID_PINS:
+        return _error(400, f"Invalid pin name: {pin_name}. Must be d0-d8")
+    
+    error = _check_control(password)
+    if error is not None:
+        return error
+    
+    # Get current state
+    current_state = latest_state.get(pin_name, "off")
+    new_state = "off" if current_state == "on" else "on"
+    
+    # Control the pin (coalesced with other toggles in the same window)
     try:
-        # Validate pin name
-        pin_name = pin_name.lower()
-        if pin_name not in [f"d{i}" for i in range(9)]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid pin name: {pin_name}. Must be d0-d8"
-            )
-        
-        # Get current state
-        current_state = latest_state.get(pin_name, "off")
-        new_state = "off" if current_state == "on" else "on"
-        
-        # Control the pin
-        request = ApplianceControlRequest(
-            pins={pin_name: new_state},
-            password=password
-        )
-        
-        return await control_appliances(request)
-        
-    except HTTPException:
-        raise
-    except Exception as e:
+        await request.app.state.toggle_batcher.submit(pin_name, new_state)
+    except aiomqtt.MqttError as e:
         logger.error(f"❌ Error toggling pin: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        return _error(500, "Failed to publish MQTT message")
+    
+    return ApplianceControlResponse(
+        success=True,
+        message="Control commands sent successfully",
+        pins_updated=[pin_name]
+    )
 
 
 @router.post("/all/{state}")
-async def control_all_pins(state: str, password: str):
+async def control_all_pins(state: str, password: str, request: Request):
     """
     Turn all pins on or off at once
     
-    State must be 'on' or 'off'
+    State must be 'on', 'off', 'high' or 'low'
     """
+    state = state.lower()
+    if state not in _ALL_PIN_BYTES:
+        return _error(400, "State must be 'on', 'off', 'high' or 'low'")
+    
+    error = _check_control(password)
+    if error is not None:
+        return error
+    
+    # Control all pins with the prebuilt message
+    # (idempotent, so skip the PUBACK round-trip)
     try:
-        if state.lower() not in ["on", "off", "high", "low"]:
-            raise HTTPException(
-                status_code=400,
-                detail="State must be 'on' or 'off'"
-            )
-        
-        # Create control for all pins
-        all_pins = {f"d{i}": state.lower() for i in range(9)}
-        
-        request = ApplianceControlRequest(
-            pins=all_pins,
-            password=password
-        )
-        
-        return await control_appliances(request)
-        
-    except HTTPException:
-        raise
-    except Exception as e:
+        await _publish(request.app.state.mqtt, _ALL_PIN_BYTES[state], qos=0)
+    except aiomqtt.MqttError as e:
         logger.error(f"❌ Error controlling all pins: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
+        return _error(500, "Failed to publish MQTT message")
+    
+    logger.info(f"✅ Published control command: all pins {state}")
+    
+    return _ALL_PINS_RESPONSE
 
-# ===== CLEANUP =====
-def shutdown_mqtt():
-    """Cleanup MQTT connection"""
-    global mqtt_client
-    if mqtt_client is not None:
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
-        logger.info("👋 MQTT client disconnected")
@@ -1,19 +1,35 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 from api.process_audio import router as audio_router
 from api.chat_responses import router as chat_router
-from api.appliance_control import router as appliance_router, shutdown_mqtt
+from api.appliance_control import router as appliance_router, mqtt_lifespan
 from eye_tracking import router as eye_router, shutdown_tracker as shutdown_eye_tracker
 
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the appliance MQTT client on startup and clean up on shutdown"""
+    logger.info("🤖 Starting Alice AI Backend...")
+    async with mqtt_lifespan(app):
+        logger.info("🚀 Alice AI Backend ready!")
+        yield
+        shutdown_eye_tracker()
+    logger.info("👋 Goodbye!")
+
+
 app = FastAPI(
     title="Alice API",
     description="Alice - Search, audio transcription, computer control, bot control",
     version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # Allow all origins for testing/dev, adjust as needed for production
@@ -35,18 +51,3 @@ app.include_router(appliance_router, prefix="/api")
 async def health():
     return {"status": "ok"}
 
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize bot MQTT client and conversation context on startup"""
-    logger.info("🤖 Starting Alice AI Backend...")
-    logger.info("🚀 Alice AI Backend ready!")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup bot MQTT client on shutdown"""
-    shutdown_eye_tracker()
-    shutdown_mqtt()
-    logger.info("👋 Goodbye!")
-